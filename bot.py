@@ -4,12 +4,19 @@
 
 import html
 import random
+import time
 import os
 import logging
+import logging.handlers
+import queue
 import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 
-import aiohttp
+import httpx
+import orjson
+from cachetools import TTLCache
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
     BotCommand, MenuButton
@@ -28,8 +35,34 @@ if not BOT_TOKEN:
 # Conversation states for ConversationHandler
 SELECTING_CATEGORY, SELECTING_DIFFICULTY, QUIZ = range(3)
 
+
+@dataclass(slots=True)
+class QuizSession:
+    """Per-user quiz progress."""
+    questions: list
+    # Per-question display order as indices into the shared, cached options tuple
+    perms: list[list[int]]
+    score: int = 0
+    index: int = 0
+    # Id of the message holding the current, still-unanswered question
+    message_id: int | None = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+# Abandoned sessions expire after an hour; the conversation times out on the same schedule
+SESSION_TTL = 3600
+
 # In-memory storage of user quiz data keyed by user_id
-user_data_store = {}
+user_data_store: TTLCache[int, QuizSession] = TTLCache(maxsize=10_000, ttl=SESSION_TTL)
+
+# Shared HTTP/2 client for OpenTDB requests, created in post_init and closed in post_shutdown
+http_client: httpx.AsyncClient | None = None
+
+# Short-lived cache of parsed questions keyed by (category_id, difficulty), evicted LRU-first.
+# Entries are immutable (question, correct_idx, options) tuples shared by every user.
+QUESTION_CACHE: OrderedDict[tuple[int, str], tuple[float, list]] = OrderedDict()
+CACHE_TTL = 30
+CACHE_MAX_ENTRIES = 64
 
 # Predefined quiz categories with OpenTDB IDs
 CATEGORIES = {
@@ -47,34 +80,70 @@ CATEGORIES = {
     "Politics": 24,
     "Art": 25
 }
+CATEGORY_BY_ID = {cid: name for name, cid in CATEGORIES.items()}
+
+# Static keyboards are built once at import instead of on every interaction
+WELCOME_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(text="🎮 Start Quiz!", callback_data="start_quiz")]])
+_category_buttons = [InlineKeyboardButton(text=cat, callback_data=str(cid)) for cat, cid in CATEGORIES.items()]
+# Two buttons per row keeps the keyboard (and its serialized markup) compact
+CATEGORY_MARKUP = InlineKeyboardMarkup([
+    _category_buttons[i:i + 2] for i in range(0, len(_category_buttons), 2)
+])
+DIFFICULTY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Easy", callback_data="easy")],
+    [InlineKeyboardButton("Medium", callback_data="medium")],
+    [InlineKeyboardButton("Hard", callback_data="hard")]
+])
+PLAY_AGAIN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔁 Play Again", callback_data="play_again")],
+    [InlineKeyboardButton("❌ Exit", callback_data="exit")]
+])
 
 
 async def fetch_questions_async(category_id: int, difficulty: str):
-    url = f"https://opentdb.com/api.php?amount=10&category={category_id}&difficulty={difficulty}&type=multiple"
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, timeout=10) as resp:
-                resp.raise_for_status()
-                data = await resp.json()
-        except Exception as e:
-            logging.error(f"Failed to fetch questions: {e}")
-            return []
+    key = (category_id, difficulty)
+    entry = QUESTION_CACHE.get(key)
+    if entry and time.monotonic() - entry[0] < CACHE_TTL:
+        QUESTION_CACHE.move_to_end(key)
+        return entry[1]
 
+    url = f"https://opentdb.com/api.php?amount=10&category={category_id}&difficulty={difficulty}&type=multiple"
+    try:
+        resp = await http_client.get(url)
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)
+    except Exception as e:
+        logging.error(f"Failed to fetch questions: {e}")
+        return []
+
+    # OpenTDB reports errors in the body; code 5 means the per-IP rate limit was hit
+    response_code = data.get('response_code', 0)
+    if response_code == 5:
+        logging.error("Failed to fetch questions: OpenTDB rate limit exceeded")
+        return []
+    if response_code != 0:
+        logging.warning(f"OpenTDB returned response_code {response_code} for {key}")
+        return []
+
+    unescape = html.unescape
     questions = []
     for item in data.get('results', []):
-        question = html.unescape(item['question'])
-        correct = html.unescape(item['correct_answer'])
-        options = [html.unescape(ans) for ans in item['incorrect_answers']]
-        options.append(correct)
-        random.shuffle(options)
-        questions.append((question, correct, options))
+        question = unescape(item['question'])
+        correct = unescape(item['correct_answer'])
+        options = (*map(unescape, item['incorrect_answers']), correct)
+        questions.append((question, len(options) - 1, options))
+
+    if questions:
+        QUESTION_CACHE[key] = (time.monotonic(), questions)
+        QUESTION_CACHE.move_to_end(key)
+        while len(QUESTION_CACHE) > CACHE_MAX_ENTRIES:
+            QUESTION_CACHE.popitem(last=False)
     return questions
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data_store.pop(update.effective_user.id, None)
 
-    welcome_buttons = [[InlineKeyboardButton(text="🎮 Start Quiz!", callback_data="start_quiz")]]
     welcome_text = (
         "🎯 Welcome to the Quiz Game Bot!\n\n"
         "Test your knowledge across various categories.\n"
@@ -83,43 +152,38 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message:
         await update.message.reply_text(
             welcome_text,
-            reply_markup=InlineKeyboardMarkup(welcome_buttons)
+            reply_markup=WELCOME_MARKUP
         )
     elif update.callback_query:
         await update.callback_query.message.edit_text(
             welcome_text,
-            reply_markup=InlineKeyboardMarkup(welcome_buttons)
+            reply_markup=WELCOME_MARKUP
         )
     return SELECTING_CATEGORY
 
 
 async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    buttons = [[InlineKeyboardButton(text=cat, callback_data=cat)] for cat in list(CATEGORIES.keys())[:10]]
     await query.answer()
     await query.edit_message_text(
         "🎯 Choose a category:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=CATEGORY_MARKUP
     )
     return SELECTING_CATEGORY
 
 
 async def category_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    category_name = query.data
+    category_id = int(query.data)
+    category_name = CATEGORY_BY_ID[category_id]
 
     context.user_data['category_name'] = category_name
-    context.user_data['category_id'] = CATEGORIES[category_name]
+    context.user_data['category_id'] = category_id
 
-    buttons = [
-        [InlineKeyboardButton("Easy", callback_data="easy")],
-        [InlineKeyboardButton("Medium", callback_data="medium")],
-        [InlineKeyboardButton("Hard", callback_data="hard")]
-    ]
     await query.answer()
     await query.edit_message_text(
         text=f"📚 You chose *{category_name}*\nNow choose a difficulty:",
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=DIFFICULTY_MARKUP,
         parse_mode="Markdown"
     )
     return SELECTING_DIFFICULTY
@@ -142,11 +206,10 @@ async def difficulty_selected(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.answer("Failed to fetch questions. Please try again later.")
         return ConversationHandler.END
 
-    user_data_store[user_id] = {
-        'questions': questions,
-        'score': 0,
-        'index': 0
-    }
+    # Shuffle per user by index so the cached option strings stay shared
+    rng = random.Random()
+    perms = [rng.sample(range(len(options)), len(options)) for _, _, options in questions]
+    user_data_store[user_id] = QuizSession(questions=questions, perms=perms)
 
     await query.answer()
     # Delete the difficulty selection message
@@ -161,90 +224,90 @@ async def difficulty_selected(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def send_question(update, context, user_id):
     data = user_data_store[user_id]
-    index = data['index']
-    question, correct, options = data['questions'][index]
-
-    callback_map = {}
-    buttons = []
-    for i, option_text in enumerate(options):
-        callback_data = f"opt{i}"
-        callback_map[callback_data] = option_text
-        buttons.append([InlineKeyboardButton(text=option_text, callback_data=callback_data)])
+    index = data.index
+    question, correct_idx, options = data.questions[index]
 
-    user_data_store[user_id]['callback_map'] = callback_map
+    buttons = [
+        [InlineKeyboardButton(text=options[j], callback_data=f"opt{i}")]
+        for i, j in enumerate(data.perms[index])
+    ]
 
     markup = InlineKeyboardMarkup(buttons)
 
     chat_id = update.effective_chat.id
-    await context.bot.send_message(
+    message = await context.bot.send_message(
         chat_id=chat_id,
         text=f"❓ Question {index + 1}:\n{question}",
         reply_markup=markup
     )
+    data.message_id = message.message_id
 
 
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
     selected_callback = query.data
-    data = user_data_store[user_id]
-
-    callback_map = data.get('callback_map', {})
-    answer = callback_map.get(selected_callback)
-    if answer is None:
-        await query.answer("Invalid selection, please try again.", show_alert=True)
-        return QUIZ
-
-    question, correct, options = data['questions'][data['index']]
-
-    # Disable buttons on the original question message
-    buttons_disabled = [
-        [InlineKeyboardButton(text=opt, callback_data="disabled")] for opt in options
-    ]
-    await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(buttons_disabled))
-
-    feedback_lines = [f"❓ *Question:* {question}\n"]
-
-    if answer == correct:
-        data['score'] += 1
-        feedback_lines.append(f"✅ Your answer: *{answer}* (Correct!)")
-    else:
-        feedback_lines.append(f"❌ Your answer: *{answer}* (Wrong!)")
-        feedback_lines.append(f"✅ Correct answer: *{correct}*")
-
-    feedback_text = "\n".join(feedback_lines)
-
-    # Send feedback as a new message so it stays visible
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text=feedback_text,
-        parse_mode="Markdown"
-    )
-
-    # Delete the original question message (optional, for cleaner chat)
-    try:
-        await query.message.delete()
-    except Exception as e:
-        logging.warning(f"Failed to delete message: {e}")
-
-    data['index'] += 1
+    data = user_data_store.get(user_id)
+    if data is None:
+        # The session expired or was evicted while the conversation was still in QUIZ
+        await query.answer("Your session expired, please /start again.", show_alert=True)
+        return ConversationHandler.END
 
-    if data['index'] < len(data['questions']):
-        await send_question(update, context, user_id)
-        return QUIZ
-    else:
-        score = data['score']
-        total = len(data['questions'])
-        buttons = [
-            [InlineKeyboardButton("🔁 Play Again", callback_data="play_again")],
-            [InlineKeyboardButton("❌ Exit", callback_data="exit")]
-        ]
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=f"🎉 Quiz Finished!\nYou scored {score}/{total}.\n\nWant to play again?",
-            reply_markup=InlineKeyboardMarkup(buttons)
+    # Serialize answers per user so a double tap can't score or advance the same question twice
+    async with data.lock:
+        # Taps on a question that has already been answered short-circuit here
+        if query.message.message_id != data.message_id:
+            await query.answer()
+            return QUIZ
+
+        question, correct_idx, options = data.questions[data.index]
+
+        # Callback data is "opt<i>" where i is the button position in this user's permutation
+        selected = selected_callback[3:]
+        if not selected_callback.startswith("opt") or not selected.isdecimal() or int(selected) >= len(options):
+            await query.answer("Invalid selection, please try again.", show_alert=True)
+            return QUIZ
+
+        selected_idx = data.perms[data.index][int(selected)]
+        # OpenTDB text is plain (already unescaped), so escape it for HTML formatting
+        answer = html.escape(options[selected_idx])
+        correct = html.escape(options[correct_idx])
+
+        feedback_lines = [f"❓ <b>Question:</b> {html.escape(question)}\n"]
+
+        if selected_idx == correct_idx:
+            feedback_lines.append(f"✅ Your answer: <b>{answer}</b> (Correct!)")
+        else:
+            feedback_lines.append(f"❌ Your answer: <b>{answer}</b> (Wrong!)")
+            feedback_lines.append(f"✅ Correct answer: <b>{correct}</b>")
+
+        feedback_text = "\n".join(feedback_lines)
+
+        # Replace the question with its feedback and drop the keyboard in a single API call
+        await query.edit_message_text(
+            text=feedback_text,
+            parse_mode="HTML",
+            reply_markup=None
         )
-        return SELECTING_CATEGORY
+
+        # Only mark the question answered once the edit went through, so a failed edit can be retried
+        data.message_id = None
+        if selected_idx == correct_idx:
+            data.score += 1
+        data.index += 1
+
+        if data.index < len(data.questions):
+            await send_question(update, context, user_id)
+            return QUIZ
+        else:
+            score = data.score
+            total = len(data.questions)
+            await context.bot.send_message(
+                chat_id=query.message.chat_id,
+                text=f"🎉 Quiz Finished!\nYou scored {score}/{total}.\n\nWant to play again?",
+                reply_markup=PLAY_AGAIN_MARKUP
+            )
+            return SELECTING_CATEGORY
 
 
 async def play_again(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -263,35 +326,62 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+# Fixed callback_data values routed while selecting a category; category buttons send their numeric id
+CATEGORY_STATE_ROUTES = {
+    "start_quiz": show_categories,
+    "play_again": play_again,
+    "exit": play_again,
+}
+
+
+async def route_category_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = update.callback_query.data
+    if data.isdecimal() and int(data) in CATEGORY_BY_ID:
+        return await category_selected(update, context)
+    handler = CATEGORY_STATE_ROUTES.get(data)
+    if handler is None:
+        await update.callback_query.answer()
+        return SELECTING_CATEGORY
+    return await handler(update, context)
+
+
 conv_handler = ConversationHandler(
     entry_points=[
         CommandHandler('start', start),
         MessageHandler(filters.TEXT & ~filters.COMMAND, start)
     ],
     states={
-        SELECTING_CATEGORY: [
-            CallbackQueryHandler(show_categories, pattern="^start_quiz$"),
-            CallbackQueryHandler(category_selected, pattern="^(?!start_quiz|play_again|exit).*$"),
-            CallbackQueryHandler(play_again, pattern="^(play_again|exit)$")
-        ],
+        SELECTING_CATEGORY: [CallbackQueryHandler(route_category_state)],
         SELECTING_DIFFICULTY: [CallbackQueryHandler(difficulty_selected)],
         QUIZ: [CallbackQueryHandler(handle_answer)],
     },
-    fallbacks=[
-        CommandHandler('cancel', cancel),
-        MessageHandler(filters.TEXT & ~filters.COMMAND, start)
-    ],
+    fallbacks=[CommandHandler('cancel', cancel)],
+    # Entry points also apply mid-conversation, so any text message restarts the quiz
+    allow_reentry=True,
+    conversation_timeout=SESSION_TTL,
     per_message=False
 )
 
 
 if __name__ == '__main__':
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    # Handlers only enqueue log records; a background thread does the actual stderr writes
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+    log_listener.start()
 
     async def setup_commands(app):
+        global http_client
+        # One long-lived HTTP/2 connection multiplexes every OpenTDB fetch, including prefetches
+        http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        )
         await app.bot.set_my_commands([
             BotCommand("start", "Start the quiz game! 🎮"),
         ])
@@ -299,8 +389,36 @@ if __name__ == '__main__':
             menu_button=MenuButton(type=MenuButton.COMMANDS)
         )
 
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(setup_commands).build()
+    async def close_http_client(app):
+        if http_client is not None:
+            await http_client.aclose()
+
+    # uvloop is optional; fall back to the default asyncio loop where it isn't available
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logging.info("uvloop not installed, using the default asyncio event loop")
+
+    # A larger send pool lets answers from many users go out concurrently instead of
+    # queueing for a connection, at the cost of holding more sockets open.
+    # Polling only ever needs one connection.
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(256)
+        .pool_timeout(30)
+        .connect_timeout(10)
+        .read_timeout(20)
+        .get_updates_connection_pool_size(1)
+        .post_init(setup_commands)
+        .post_shutdown(close_http_client)
+        .build()
+    )
     app.add_handler(conv_handler)
 
-    print("Bot is running...")
-    app.run_polling()
+    logging.info("Bot is running...")
+    try:
+        app.run_polling()
+    finally:
+        log_listener.stop()